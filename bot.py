@@ -2,25 +2,57 @@ import os
 import json
 import asyncio
 import contextlib
+import time
 import discord
-from collections import defaultdict
-from aiohttp import ClientSession
+from collections import defaultdict, deque
+from aiohttp import ClientSession, ClientTimeout
 from discord.ext import commands
 from discord_slash import SlashCommand
 import tweepy
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import logging
 from discord import Embed
 from dotenv import load_dotenv
-import aiomysql
+from headlines import is_similar_headline, remove_similar_headlines
+import asyncmy
+from asyncmy.cursors import DictCursor
 
 load_dotenv()
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+class NewswireBot(commands.Bot):
+    tweet_streamer_task = None
+    tweet_workers = ()
+
+    async def setup_hook(self):
+        global pool
+        # Runs once before connecting to Discord, so the pool is ready before
+        # the streamer or any command touches it
+        pool = await get_pool()
+        await create_table(pool)
+
+        # The queue and its workers outlive reconnects, so tweets already read are still handled
+        queue = asyncio.Queue(maxsize=TWEET_QUEUE_SIZE)
+        self.tweet_workers = [self.loop.create_task(tweet_worker(queue)) for _ in range(TWEET_WORKERS)]
+        self.tweet_streamer_task = self.loop.create_task(tweet_streamer(queue))
+
+    async def close(self):
+        # Stop streaming and handling tweets first, as they use the pool
+        tasks = [task for task in (self.tweet_streamer_task, *self.tweet_workers) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Release the warm MySQL connections before the event loop goes away
+        if pool is not None:
+            pool.close()
+            await pool.wait_closed()
+        await super().close()
+
+
+bot = NewswireBot(command_prefix="!", intents=intents)
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -30,6 +62,7 @@ TWITTER_API_KEY = os.getenv("TWITTER_API_KEY")
 TWITTER_API_SECRET = os.getenv("TWITTER_API_SECRET")
 TWITTER_ACCESS_TOKEN = os.getenv("TWITTER_ACCESS_TOKEN")
 TWITTER_ACCESS_SECRET = os.getenv("TWITTER_ACCESS_SECRET")
+TWITTER_BEARER_TOKEN = os.getenv("TWITTER_BEARER_TOKEN")
 
 # Setup Slash commands
 from discord_slash import SlashCommand
@@ -39,13 +72,66 @@ auth = tweepy.OAuthHandler(os.environ["API_KEY"], os.environ["API_SECRET"])
 auth.set_access_token(os.environ["ACCESS_TOKEN"], os.environ["ACCESS_SECRET"])
 api = tweepy.API(auth, wait_on_rate_limit=True)
 
+# Twitter API v2 filtered stream, delivering tweets of the monitored accounts as they are posted
+STREAM_URL = "https://api.twitter.com/2/tweets/search/stream"
+STREAM_RULES_URL = f"{STREAM_URL}/rules"
+STREAM_PARAMS = {
+    "expansions": "attachments.media_keys,author_id",
+    "media.fields": "type,url,preview_image_url,variants",
+    "user.fields": "username",
+}
+
+# Twitter API v2 user timeline, used to catch up on tweets posted while the stream was down
+USER_TWEETS_URL = "https://api.twitter.com/2/users/{}/tweets"
+
+# Discord channels per monitored account, refreshed whenever the stream rules are synced
+account_channels = {}
+
+# Headlines each account posted recently, as (monotonic time, text), which new
+# tweets are deduplicated against. Polling only compared the tweets of one 30
+# second poll; on the stream a short time window keeps that intent, catching
+# quick rewordings and reposts of a story while later follow-ups on the same
+# topic are still posted. The length cap only bounds memory in a burst
+RECENT_TWEETS_SECONDS = 5 * 60
+RECENT_TWEETS_WINDOW = 100
+recent_tweets = defaultdict(lambda: deque(maxlen=RECENT_TWEETS_WINDOW))
+
+# Stream events waiting to be handled, and the workers handling them. Reading
+# the stream only enqueues, so it never waits on Discord or MySQL and keeps up
+# with a burst instead of being disconnected as a slow consumer. When the queue
+# is full, reading waits for a free slot rather than drop a tweet, since the
+# last tweet id of its account would move past it and it would never be
+# caught up on
+TWEET_QUEUE_SIZE = 1000
+TWEET_WORKERS = 8
+
+# Most missed tweets caught up on per account, the newest ones, so that after
+# a long outage the backfill cannot take most of the queue from live tweets
+BACKFILL_MAX_TWEETS = 200
+
+# Handling is serialized per account, so its tweets are deduplicated against
+# each other and posted in the order they were enqueued while other accounts
+# proceed. Workers take the lock without awaiting anything before it, so its
+# waiters line up in queue order
+account_locks = defaultdict(asyncio.Lock)
+
 
 async def get_pool():
-    return await aiomysql.create_pool(
+    return await asyncmy.create_pool(
         host=os.getenv("MYSQL_HOST"),
         user=os.getenv("MYSQL_USER"),
         password=os.getenv("MYSQL_PASSWORD"),
-        db=os.getenv("MYSQL_DATABASE"),
+        database=os.getenv("MYSQL_DATABASE"),
+        # Keep warm connections for bursts of polls and commands, and recycle
+        # them before MySQL's idle timeout drops them
+        minsize=5,
+        maxsize=20,
+        pool_recycle=300,
+        autocommit=False,
+        charset="utf8mb4",
+        # Run parameterized queries as server-side prepared statements cached
+        # per connection, so the hot last_tweet_id UPDATE is parsed only once
+        stmt_cache_size=32,
     )
 
 pool = None
@@ -62,6 +148,28 @@ async def create_table(pool):
                                     media_only BOOLEAN DEFAULT FALSE,
                                     similarity_threshold FLOAT DEFAULT 0.5
                                 )""")
+            await cur.execute("""CREATE TABLE IF NOT EXISTS monitored_twitter_accounts (
+                                    id BIGINT PRIMARY KEY AUTO_INCREMENT,
+                                    twitter_id BIGINT NOT NULL UNIQUE,
+                                    twitter_handle VARCHAR(255) NOT NULL,
+                                    last_tweet_id BIGINT
+                                )""")
+            # CREATE TABLE IF NOT EXISTS leaves an existing table as it is, so add
+            # the unique key the upsert in add_twitter_account relies on if it is
+            # missing. The ALTER fails at startup if duplicate accounts already exist
+            await cur.execute("""SELECT index_name FROM information_schema.statistics
+                                 WHERE table_schema = DATABASE()
+                                   AND table_name = 'monitored_twitter_accounts'
+                                   AND non_unique = 0
+                                 GROUP BY index_name
+                                 HAVING COUNT(*) = 1 AND MAX(column_name) = 'twitter_id'""")
+            if not await cur.fetchone():
+                await cur.execute("ALTER TABLE monitored_twitter_accounts ADD UNIQUE KEY twitter_id_unique (twitter_id)")
+            await cur.execute("""CREATE TABLE IF NOT EXISTS twitter_account_channels (
+                                    id BIGINT PRIMARY KEY AUTO_INCREMENT,
+                                    twitter_account_id BIGINT NOT NULL,
+                                    discord_channel_id BIGINT NOT NULL
+                                )""")
             await conn.commit()
 
 async def add_twitter_channel(pool, twitter_account, channel_id, retweets, replies, media_only, similarity_threshold):
@@ -73,9 +181,6 @@ async def add_twitter_channel(pool, twitter_account, channel_id, retweets, repli
 
 @bot.event
 async def on_ready():
-    global pool
-    pool = await get_pool()
-    await create_table(pool)
     print(f'{bot.user.name} has connected to Discord!')
 
 @bot.command(name='start')
@@ -91,22 +196,15 @@ async def add_twitter_account(twitter_handle: str, channel_id: int):
             # Get user info
             user = api.get_user(screen_name=twitter_handle)
 
-            # Check if the account is already being monitored
+            # Add the account to the monitored accounts, or refresh the handle
+            # of an already monitored one, which may have been renamed; either
+            # way LAST_INSERT_ID() yields its id
             await cur.execute(
-                "SELECT id FROM monitored_twitter_accounts WHERE twitter_id = %s",
-                (user.id,)
+                "INSERT INTO monitored_twitter_accounts (twitter_id, twitter_handle) VALUES (%s, %s) "
+                "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id), twitter_handle = %s",
+                (user.id, user.screen_name, user.screen_name)
             )
-            account_id = await cur.fetchone()
-
-            if account_id:
-                account_id = account_id[0]
-            else:
-                # Add the new account to the monitored accounts
-                await cur.execute(
-                    "INSERT INTO monitored_twitter_accounts (twitter_id, twitter_handle) VALUES (%s, %s)",
-                    (user.id, user.screen_name)
-                )
-                account_id = cur.lastrowid
+            account_id = cur.lastrowid
 
             # Link the account to the specified channel
             await cur.execute(
@@ -115,6 +213,10 @@ async def add_twitter_account(twitter_handle: str, channel_id: int):
             )
             await conn.commit()
 
+    # Start streaming the new account's tweets
+    async with twitter_session() as session:
+        await sync_stream_rules(session)
+
 
 # Slash command to start monitoring a Twitter account
 @slash.slash(name="start", description="Start monitoring a Twitter account.")
@@ -123,123 +225,255 @@ async def _start(ctx, twitter_handle: str):
     await ctx.send(f"Now monitoring {twitter_handle} in this channel.")
 
 
-# Function to remove similar headlines based on cosine similarity with TF-IDF
-def remove_similar_headlines_tfidf(tweets, similarity_threshold=0.4):
-    unique_tweets = []
+def twitter_session():
+    return ClientSession(headers={"Authorization": f"Bearer {TWITTER_BEARER_TOKEN}"})
 
-    vectorizer = TfidfVectorizer(stop_words='english')
-    for tweet in tweets:
-        tweet_text = tweet.full_text.lower().strip()
-        is_unique = True
 
-        if unique_tweets:
-            tweet_texts = [unique_tweet.full_text.lower().strip() for unique_tweet in unique_tweets]
-            tweet_texts.append(tweet_text)
-            tfidf_matrix = vectorizer.fit_transform(tweet_texts)
-            similarity_matrix = cosine_similarity(tfidf_matrix)
+# Load the monitored accounts and make the filtered stream rules match them.
+# Each rule is tagged with the account id so matched tweets can be routed
+async def sync_stream_rules(session):
+    global account_channels
 
-            for similarity in similarity_matrix[-1][:-1]:
-                if similarity >= similarity_threshold:
-                    is_unique = False
-                    break
+    async with pool.acquire() as conn:
+        async with conn.cursor(DictCursor) as cur:
+            await cur.execute("SELECT id, twitter_id, twitter_handle, last_tweet_id FROM monitored_twitter_accounts")
+            accounts = await cur.fetchall()
 
-        if is_unique:
-            unique_tweets.append(tweet)
+        # Look up the channels of every account in a single query
+        channels = defaultdict(list)
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT twitter_account_id, discord_channel_id FROM twitter_account_channels")
+            for account_id, channel_id in await cur.fetchall():
+                channels[account_id].append(channel_id)
+
+        # End the read transaction, or the pool closes the connection on
+        # release instead of keeping it warm
+        await conn.commit()
+
+    # Resolve the Discord channels once here rather than for every tweet
+    account_channels = {
+        account_id: [channel for channel in map(bot.get_channel, channel_ids) if channel]
+        for account_id, channel_ids in channels.items()
+    }
+
+    wanted_rules = {str(account["id"]): f"from:{account['twitter_handle']}" for account in accounts}
+
+    async with session.get(STREAM_RULES_URL) as resp:
+        resp.raise_for_status()
+        current_rules = (await resp.json()).get("data", [])
+
+    stale_ids = [rule["id"] for rule in current_rules if wanted_rules.get(rule.get("tag")) != rule["value"]]
+    if stale_ids:
+        async with session.post(STREAM_RULES_URL, json={"delete": {"ids": stale_ids}}) as resp:
+            resp.raise_for_status()
+
+    existing_tags = {rule.get("tag") for rule in current_rules if rule["id"] not in stale_ids}
+    new_rules = [{"value": value, "tag": tag} for tag, value in wanted_rules.items() if tag not in existing_tags]
+    if new_rules:
+        async with session.post(STREAM_RULES_URL, json={"add": new_rules}) as resp:
+            resp.raise_for_status()
+
+    return accounts
+
+
+# Fetch the tweets an account posted after since_id, oldest first, shaped like
+# stream events so they can go through the same handling
+async def fetch_missed_tweets(session, account, since_id):
+    params = {**STREAM_PARAMS, "since_id": since_id, "max_results": 100}
+    tweets = []
+    media_by_key = {}
+    users_by_id = {}
+    while True:
+        async with session.get(USER_TWEETS_URL.format(account["twitter_id"]), params=params) as resp:
+            resp.raise_for_status()
+            page = await resp.json()
+        tweets.extend(page.get("data", []))
+        media_by_key.update((media["media_key"], media) for media in page.get("includes", {}).get("media", []))
+        users_by_id.update((user["id"], user) for user in page.get("includes", {}).get("users", []))
+
+        next_token = page.get("meta", {}).get("next_token")
+        if not next_token:
+            break
+        if len(tweets) >= BACKFILL_MAX_TWEETS:
+            print(f"Only catching up on the last {len(tweets)} missed tweets of {account['twitter_handle']}")
+            break
+        params["pagination_token"] = next_token
+
+    return [
+        {
+            "data": tweet,
+            "includes": {
+                "media": [
+                    media_by_key[media_key]
+                    for media_key in tweet.get("attachments", {}).get("media_keys", [])
+                    if media_key in media_by_key
+                ],
+                "users": [users_by_id[tweet["author_id"]]] if tweet.get("author_id") in users_by_id else [],
+            },
+            "matching_rules": [{"tag": str(account["id"])}],
+        }
+        for tweet in reversed(tweets)
+    ]
+
+
+# Catch up on what the monitored accounts posted while the stream was down,
+# starting from the last tweet handled for each of them
+async def backfill_tweets(session, accounts, queue):
+    accounts = [account for account in accounts if account["last_tweet_id"]]
+    results = await asyncio.gather(
+        *(fetch_missed_tweets(session, account, account["last_tweet_id"]) for account in accounts),
+        return_exceptions=True,
+    )
+    for account, missed_tweets in zip(accounts, results):
+        if isinstance(missed_tweets, Exception):
+            print(f"Error fetching missed tweets for {account['twitter_handle']}: {missed_tweets}")
+            continue
+
+        # Deduplicate the missed tweets among themselves, as a poll did
+        unique_tweets = await asyncio.get_running_loop().run_in_executor(
+            None, remove_similar_headlines, missed_tweets
+        )
+        for tweet in unique_tweets:
+            await queue.put(tweet)
+
+
+# Deduplicate a tweet from the stream and send it to the channels of every account it matched
+async def handle_stream_tweet(tweet):
+    # The embed is the same for every account and channel the tweet goes to
+    embed = build_tweet_embed(tweet)
+
+    for rule in tweet.get("matching_rules", []):
+        account_id = int(rule["tag"])
+
+        async with account_locks[account_id]:
+            # Remove duplicate headlines against what this account posted recently.
+            # A tweet both streamed and backfilled after a reconnect repeats its
+            # text exactly, so it is dropped here too. This is CPU work, so keep it
+            # off the event loop and its Discord heartbeats
+            recent = recent_tweets[account_id]
+            now = time.monotonic()
+            while recent and now - recent[0][0] > RECENT_TWEETS_SECONDS:
+                recent.popleft()
+            text = tweet['data']['text']
+            is_duplicate = await asyncio.get_running_loop().run_in_executor(
+                None, is_similar_headline, text, [recent_text for _, recent_text in recent]
+            )
 
-    return unique_tweets
+            if not is_duplicate:
+                recent.append((now, text))
+
+                # Send to all channels concurrently; one failing channel must not stop the others
+                channels = account_channels.get(account_id, [])
+                results = await asyncio.gather(
+                    *(channel.send(embed=embed) for channel in channels),
+                    return_exceptions=True,
+                )
+                for channel, result in zip(channels, results):
+                    if isinstance(result, Exception):
+                        print(f"Error sending tweet to channel {channel.id}: {result}")
+
+            # Update last_tweet_id, which the backfill after a reconnect starts
+            # from. Backfilled tweets can be older than ones already streamed
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(
+                        "UPDATE monitored_twitter_accounts SET last_tweet_id = GREATEST(COALESCE(last_tweet_id, 0), %s) WHERE id = %s",
+                        (int(tweet['data']['id']), account_id)
+                    )
+                    await conn.commit()
+
+
+# Handle queued stream events one at a time; several workers run side by side
+async def tweet_worker(queue):
+    while True:
+        tweet = await queue.get()
+        try:
+            await handle_stream_tweet(tweet)
+        except Exception as e:
+            print(f"Error handling tweet {tweet['data']['id']}: {e}")
+        finally:
+            queue.task_done()
 
 
 # Function to stream tweets
-async def stream_tweets():
-    while True:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SELECT * FROM monitored_twitter_accounts")
-                accounts = await cur.fetchall()
-
-                for account in accounts:
-                    id, twitter_id, twitter_handle, last_tweet_id = account
-
-                    # Get tweets since the last stored tweet ID
-                    try:
-                        if last_tweet_id:
-                            tweets = api.user_timeline(
-                                user_id=twitter_id,
-                                since_id=last_tweet_id,
-                                tweet_mode="extended",
-                                include_rts=True,
-                            )
-                        else:
-                            tweets = api.user_timeline(
-                                user_id=twitter_id,
-                                count=1,
-                                tweet_mode="extended",
-                                include_rts=True,
-                            )
-
-                        # Remove duplicate headlines
-                        unique_tweets = remove_similar_headlines_tfidf(tweets)
-
-                        # Send tweets to channels
-                        for tweet in unique_tweets[::-1]:
-                            await cur.execute(
-                                "SELECT discord_channel_id FROM twitter_account_channels WHERE twitter_account_id = %s",
-                                (id,)
-                            )
-                            channel_ids = await cur.fetchall()
-
-                            for channel_id in channel_ids:
-                                channel = bot.get_channel(channel_id[0])
-                                if channel:
-                                    await channel.send(
-                                        f"**{tweet.user.screen_name}:** {tweet.full_text}\nhttps://twitter.com/i/web/status/{tweet.id}"
-                                    )
-
-                            # Update last_tweet_id
-                            await cur.execute(
-                                "UPDATE monitored_twitter_accounts SET last_tweet_id = %s WHERE id = %s",
-                                (tweet.id, id)
-                            )
-                            await conn.commit()
-
-                    except tweepy.TweepError as e:
-                        print(f"Error fetching tweets for {twitter_handle}: {e}")
-
-
-        # Wait before checking for new tweets
-        await asyncio.sleep(30)
-
-async def post_tweet_to_discord(client, tweet, channel_id):
-    channel = client.get_channel(channel_id)
-    embed = Embed(title=tweet['data']['text'], url=f"https://twitter.com/i/web/status/{tweet['data']['id']}", color=0x1DA1F2)
+async def stream_tweets(queue):
+    async with twitter_session() as session:
+        accounts = await sync_stream_rules(session)
+
+        # The stream stays open indefinitely; only give up on a read that
+        # outlasts several of Twitter's 20 second keep-alives
+        async with session.get(STREAM_URL, params=STREAM_PARAMS, timeout=ClientTimeout(total=None, sock_read=90)) as resp:
+            resp.raise_for_status()
+
+            # The stream is already connected, so nothing posted while catching
+            # up is missed. Catch up alongside reading, and let it finish before
+            # the session closes. Live tweets read meanwhile are newer than the
+            # missed ones, so they are held back and enqueued after them
+            held_back = deque()
+
+            async def catch_up():
+                try:
+                    await backfill_tweets(session, accounts, queue)
+                finally:
+                    while held_back:
+                        await queue.put(held_back.popleft())
+
+            backfill = asyncio.create_task(catch_up())
+            try:
+                async for line in resp.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    event = json.loads(line)
+                    if "data" not in event:
+                        print(f"Error from tweet stream: {event.get('errors', event)}")
+                        continue
+                    if backfill.done():
+                        await queue.put(event)
+                    else:
+                        held_back.append(event)
+            finally:
+                await backfill
+
+def build_tweet_embed(tweet):
+    # Discord caps an embed title at 256 characters and a description at 4096,
+    # so the text goes in the description and the title links the tweet under
+    # its author's handle
+    users = tweet.get('includes', {}).get('users', [])
+    author = next((user for user in users if user['id'] == tweet['data'].get('author_id')), None)
+    title = f"@{author['username']}" if author else "Tweet"
+    embed = Embed(title=title, description=tweet['data']['text'], url=f"https://twitter.com/i/web/status/{tweet['data']['id']}", color=0x1DA1F2)
 
     # Handle media attachments
     if 'attachments' in tweet['data']:
         media_keys = tweet['data']['attachments'].get('media_keys', [])
+        media_by_key = {media['media_key']: media for media in tweet.get('includes', {}).get('media', [])}
         for media_key in media_keys:
-            media = tweet['includes']['media'][media_keys.index(media_key)]
-            media_url = media['url']
+            media = media_by_key.get(media_key)
+            if media is None:
+                continue
 
             if media['type'] in ['photo', 'animated_gif']:
-                embed.set_image(url=media_url)
+                # v2 only gives GIFs a preview image
+                embed.set_image(url=media.get('url') or media['preview_image_url'])
             elif media['type'] == 'video':
                 # Get the best quality video variant
-                best_variant = max(media['video_info']['variants'], key=lambda variant: variant.get('bitrate', 0))
-                embed.description = f"[Video link]({best_variant['url']})"
+                best_variant = max(media['variants'], key=lambda variant: variant.get('bit_rate', 0))
+                embed.description += f"\n\n[Video link]({best_variant['url']})"
 
-    await channel.send(embed=embed)
+    return embed
 
 # Start the tweet streaming background task
-async def tweet_streamer():
+async def tweet_streamer(queue):
     await bot.wait_until_ready()
+
     while not bot.is_closed():
         try:
-            await stream_tweets()
+            await stream_tweets(queue)
         except Exception as e:
             print(f"Error streaming tweets: {e}")
             await asyncio.sleep(30)
 
-bot.loop.create_task(tweet_streamer())
-
 if __name__ == "__main__":
     bot.run(os.environ["DISCORD_TOKEN"])
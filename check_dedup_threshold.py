@@ -0,0 +1,114 @@
+# Checks HEADLINE_SIMILARITY_THRESHOLD against labeled headline pairs. Run it
+# after changing the threshold or how headlines are compared:
+#
+#     python check_dedup_threshold.py
+from headlines import HEADLINE_SIMILARITY_THRESHOLD, analyze_headline
+
+# The same headline posted again with a link, a wire tag or a small edit. These
+# must all be caught
+REPOSTS = [
+    ("Stocks tumble as oil prices surge", "Stocks tumble as oil prices surge https://t.co/abc123"),
+    ("Supreme Court strikes down affirmative action in college admissions", "BREAKING: Supreme Court strikes down affirmative action in college admissions"),
+    ("Apple unveils new iPhone 16 at September event", "BREAKING: Apple unveils the new iPhone 16 at its September event"),
+    ("WATCH LIVE: SpaceX Starship launch", "WATCH LIVE: SpaceX Starship launch https://t.co/x9Yq2"),
+    ("Queen Elizabeth II has died, Buckingham Palace announces", "BREAKING: Queen Elizabeth II has died, Buckingham Palace announces"),
+    ("Microsoft to acquire Activision Blizzard for $69 billion", "JUST IN: Microsoft to acquire Activision Blizzard for $69 billion"),
+    ("Amazon to lay off 18,000 employees", "UPDATE: Amazon to lay off 18,000 employees"),
+    ("Hurricane Ian makes landfall in southwest Florida as Category 4 storm", "Hurricane Ian makes landfall in southwest Florida as a Category 4 storm"),
+    ("Tesla recalls 2 million vehicles over Autopilot concerns", "Tesla recalls 2 million vehicles over Autopilot concerns - live updates"),
+    ("NASA launches Artemis I mission to the Moon", "NASA launches Artemis I mission to the moon!"),
+    ("Death toll in Turkey earthquake rises to 5,000", "Death toll in Turkey earthquake rises to 5,000 https://t.co/k2"),
+    ("Ukraine says it has retaken the city of Kherson", "Ukraine says it has retaken the city of Kherson, officials say"),
+    ("OpenAI releases GPT-4", "OpenAI releases GPT-4 https://t.co/gpt4"),
+    ("UK Prime Minister announces resignation", "UK Prime Minister announces his resignation"),
+    ("Trump indicted in New York hush money case", "BREAKING: Trump indicted in New York hush money case"),
+]
+
+# The same news in other words. Catching these is a bonus, never at the cost of
+# dropping different news
+REWORDINGS = [
+    ("BREAKING: Fed raises interest rates by 0.25 percentage points", "Fed raises interest rates by a quarter percentage point"),
+    ("BREAKING: Earthquake of magnitude 7.1 strikes off the coast of Japan", "Magnitude 7.1 earthquake strikes off Japan's coast"),
+    ("Apple unveils new iPhone 16 at September event", "BREAKING: Apple unveils the new iPhone 16 at its September event"),
+    ("UK Prime Minister announces resignation", "UK Prime Minister announces his resignation - live updates"),
+    ("Stocks tumble as oil prices surge", "Stocks tumble as oil prices surge https://t.co/abc123"),
+    ("Death toll in Turkey earthquake rises to 5,000", "Turkey earthquake death toll rises to more than 5,000"),
+    ("NASA launches Artemis I mission to the Moon", "NASA's Artemis I mission launches to the moon"),
+    ("Supreme Court strikes down affirmative action in college admissions", "BREAKING: Supreme Court strikes down affirmative action in college admissions"),
+    ("Tesla recalls 2 million vehicles over Autopilot concerns", "Tesla recalls over 2 million vehicles over Autopilot safety concerns"),
+    ("Heavy snow forces closure of all Denver schools on Monday", "Denver schools closed Monday due to heavy snow"),
+    ("JUST IN: Twitter CEO Parag Agrawal fired after Musk takeover", "Parag Agrawal fired as Twitter CEO after Elon Musk takeover"),
+    ("Queen Elizabeth II has died, Buckingham Palace announces", "BREAKING: Buckingham Palace announces Queen Elizabeth II has died"),
+    ("US inflation falls to 3% in June, lowest in two years", "US inflation drops to 3% in June, the lowest level in two years"),
+    ("Microsoft to acquire Activision Blizzard for $69 billion", "Microsoft agrees to buy Activision Blizzard for $69bn"),
+    ("Amazon to lay off 18,000 employees", "Amazon says it will lay off more than 18,000 employees"),
+    ("Argentina win the World Cup after penalty shootout against France", "Argentina beat France on penalties to win the World Cup"),
+    ("Hurricane Ian makes landfall in southwest Florida as Category 4 storm", "Hurricane Ian makes landfall in Florida as a Category 4 hurricane"),
+    ("Police: 3 dead, 5 injured in shooting at Michigan State University", "3 killed and 5 wounded in shooting at Michigan State University, police say"),
+    ("OpenAI releases GPT-4", "OpenAI has released GPT-4, its latest AI model"),
+    ("Silicon Valley Bank collapses in largest bank failure since 2008", "SVB collapse is the largest US bank failure since 2008"),
+    ("UPDATE: Wildfire near Los Angeles grows to 10,000 acres, evacuations ordered", "Wildfire near Los Angeles grows to 10,000 acres; evacuation orders issued"),
+    ("Biden signs debt ceiling bill into law, averting default", "President Biden signs debt ceiling bill, averting a US default"),
+    ("Titan submersible: Coast Guard says debris found near Titanic", "Coast Guard says debris found near the Titanic in search for Titan submersible"),
+    ("WATCH LIVE: SpaceX Starship launch", "SpaceX Starship launch - watch live"),
+    ("Ukraine says it has retaken the city of Kherson", "Ukrainian forces retake Kherson, Ukraine says"),
+]
+
+# Different news on the same topic, often in the same words. None of these may
+# be caught
+DIFFERENT_NEWS = [
+    ("BREAKING: Fed raises interest rates by 0.25 percentage points", "BREAKING: Fed holds interest rates steady at its June meeting"),
+    ("Fed raises interest rates by 0.25 percentage points", "Fed holds interest rates steady at its June meeting"),
+    ("Opinion: Why the new tax plan will hurt the middle class", "Opinion: Why the new housing plan will help renters"),
+    ("BREAKING: Earthquake of magnitude 7.1 strikes off the coast of Japan", "BREAKING: Tsunami warning lifted for Japan's Pacific coast"),
+    ("Apple unveils new iPhone 16 at September event", "Apple shares fall after iPhone 16 sales disappoint"),
+    ("UK Prime Minister announces resignation", "UK Prime Minister announces new cabinet"),
+    ("Stocks tumble as oil prices surge", "Stocks rally as oil prices fall"),
+    ("Death toll in Turkey earthquake rises to 5,000", "Rescuers pull child alive from rubble in Turkey earthquake"),
+    ("Supreme Court strikes down affirmative action in college admissions", "Supreme Court to hear challenge to student loan forgiveness plan"),
+    ("Tesla recalls 2 million vehicles over Autopilot concerns", "Tesla reports record quarterly deliveries"),
+    ("Live: President delivers State of the Union address", "Live: Republican response to the State of the Union address"),
+    ("Man United beat Liverpool 2-1 in Premier League", "Man City beat Arsenal 4-1 in Premier League"),
+    ("Apple stock falls 3% after earnings miss", "Apple stock rises 3% after earnings beat"),
+    ("US inflation falls to 3% in June, lowest in two years", "US unemployment rises to 3.9% in June"),
+    ("Amazon to lay off 18,000 employees", "Google to lay off 12,000 employees"),
+    ("Police: 3 dead, 5 injured in shooting at Michigan State University", "Police: suspect in Michigan State University shooting found dead"),
+    ("Hurricane Ian makes landfall in southwest Florida as Category 4 storm", "Hurricane Ian strengthens to Category 3 as it nears Cuba"),
+    ("Biden signs debt ceiling bill into law, averting default", "House passes debt ceiling bill, sending it to the Senate"),
+    ("UPDATE: Wildfire near Los Angeles grows to 10,000 acres, evacuations ordered", "UPDATE: Wildfire near Los Angeles now 50% contained, evacuation orders lifted"),
+    ("Ukraine says it has retaken the city of Kherson", "Russia says it has captured the town of Soledar"),
+    ("WATCH LIVE: SpaceX Starship launch", "WATCH LIVE: Blue Origin New Shepard launch"),
+    ("Microsoft to acquire Activision Blizzard for $69 billion", "FTC sues to block Microsoft's acquisition of Activision Blizzard"),
+    ("Dow closes up 300 points", "Dow closes down 500 points"),
+    ("Polls close in Georgia Senate runoff", "AP: Warnock wins Georgia Senate runoff"),
+    ("Trump indicted in New York hush money case", "Trump pleads not guilty in New York hush money case"),
+]
+
+
+def headline_similarity(text, other_text):
+    buckets, weights = analyze_headline(text)
+    other_buckets, other_weights = analyze_headline(other_text)
+    common = {bucket: weight for bucket, weight in zip(buckets, weights)}
+    return float(sum(common.get(bucket, 0) * weight for bucket, weight in zip(other_buckets, other_weights)))
+
+
+def print_scores(name, pairs):
+    print(f"{name}:")
+    scores = [headline_similarity(*pair) for pair in pairs]
+    for score, (text, other_text) in sorted(zip(scores, pairs)):
+        print(f"{score:.2f}  {text!r} / {other_text!r}")
+    print()
+    return scores
+
+
+if __name__ == "__main__":
+    repost_scores = print_scores("reposts", REPOSTS)
+    rewording_scores = print_scores("rewordings", REWORDINGS)
+    different_scores = print_scores("different news", DIFFERENT_NEWS)
+
+    print(f"reposts: {min(repost_scores):.2f} and up")
+    print(f"different news: up to {max(different_scores):.2f}")
+    caught = sum(score >= HEADLINE_SIMILARITY_THRESHOLD for score in rewording_scores)
+    print(f"rewordings caught at {HEADLINE_SIMILARITY_THRESHOLD}: {caught} of {len(rewording_scores)}")
+
+    assert max(different_scores) < HEADLINE_SIMILARITY_THRESHOLD <= min(repost_scores)
@@ -0,0 +1,109 @@
+import re
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+# Side of the square tiles the similarity matrix is computed in when
+# deduplicating headlines, so each float tile stays in cache
+SIMILARITY_TILE_SIZE = 64
+
+# Cosine similarity of the char n-gram vectors at which two headlines count as
+# duplicates. On the labeled pairs in check_dedup_threshold.py, reposts of a
+# headline score 0.84 and up while different news on the same topic scores up
+# to 0.79, so rewordings below the cut are posted rather than risk dropping news
+HEADLINE_SIMILARITY_THRESHOLD = 0.82
+
+# Buckets headline n-grams are hashed into. A power of two, so a bucket is a
+# bit mask of the hash, and small enough for a batch to stay in cache
+HEADLINE_DIM = 4096
+
+
+# Links and leading wire tags like "BREAKING:" are added to reposts of a
+# headline without changing the news, so they are left out of the comparison
+URL_PATTERN = re.compile(r"https?://\S+")
+WIRE_TAG_PATTERN = re.compile(r"^[A-Z]+(?: [A-Z]+)*:\s*")
+
+
+# Character n-grams catch headlines that differ only by small edits. Like
+# sklearn's char_wb analyzer, n-grams are taken inside space-padded words
+def _headline_ngrams(text):
+    text = WIRE_TAG_PATTERN.sub("", URL_PATTERN.sub("", text).strip())
+    for word in text.lower().split():
+        word = f" {word} "
+        for n in range(3, 6):
+            for i in range(max(len(word) - n, 0) + 1):
+                yield word[i:i + n]
+            if len(word) <= n:
+                break
+
+
+# Every new tweet is compared against the account's recent tweets, so
+# remember the hashed n-gram weights of recently seen texts
+@lru_cache(maxsize=4096)
+def analyze_headline(text):
+    hashes = np.fromiter(
+        (zlib.crc32(ngram.encode()) & (HEADLINE_DIM - 1) for ngram in _headline_ngrams(text)),
+        dtype=np.uint16,
+    )
+    buckets, counts = np.unique(hashes, return_counts=True)
+    weights = (counts / np.linalg.norm(counts)).astype(np.float32)
+    buckets.flags.writeable = weights.flags.writeable = False
+    return buckets, weights
+
+
+# Function to remove similar headlines based on cosine similarity of hashed character n-grams
+def remove_similar_headlines(tweets, similarity_threshold=HEADLINE_SIMILARITY_THRESHOLD):
+    if len(tweets) <= 1:
+        return list(tweets)
+
+    # Exact repeats would match anyway, so drop them with a set lookup and
+    # only compare the distinct texts as vectors
+    seen_texts = set()
+    distinct_tweets = []
+    for tweet in tweets:
+        if tweet['data']['text'] not in seen_texts:
+            seen_texts.add(tweet['data']['text'])
+            distinct_tweets.append(tweet)
+    tweets = distinct_tweets
+    if len(tweets) <= 1:
+        return tweets
+
+    vectors = np.zeros((len(tweets), HEADLINE_DIM), dtype=np.float32)
+    for row, tweet in zip(vectors, tweets):
+        buckets, weights = analyze_headline(tweet['data']['text'])
+        row[buckets] = weights
+
+    # Rows are L2-normalized, so the dot product is the cosine similarity.
+    # Compute it tile by tile against the earlier tweets only, reducing each
+    # tile to a boolean mask right away, and keep a tweet if no kept tweet
+    # before it is too similar
+    kept = np.zeros(len(tweets), dtype=bool)
+    for start in range(0, len(tweets), SIMILARITY_TILE_SIZE):
+        stop = min(start + SIMILARITY_TILE_SIZE, len(tweets))
+        rows = vectors[start:stop]
+        similar = np.empty((stop - start, stop), dtype=bool)
+        for col in range(0, stop, SIMILARITY_TILE_SIZE):
+            col_stop = min(col + SIMILARITY_TILE_SIZE, stop)
+            similar[:, col:col_stop] = np.dot(rows, vectors[col:col_stop].T) >= similarity_threshold
+        for i in range(start, stop):
+            kept[i] = not similar[i - start, :i][kept[:i]].any()
+
+    return [tweet for tweet, keep in zip(tweets, kept) if keep]
+
+
+# Whether a headline is too similar to any of the given earlier headlines. Only
+# the new headline's row of the similarity matrix is needed, and the cached
+# sparse weights give each entry of it in O(n-grams) without a dense matrix
+def is_similar_headline(text, earlier_texts, similarity_threshold=HEADLINE_SIMILARITY_THRESHOLD):
+    vector = np.zeros(HEADLINE_DIM, dtype=np.float32)
+    buckets, weights = analyze_headline(text)
+    vector[buckets] = weights
+
+    for earlier_text in earlier_texts:
+        if earlier_text == text:
+            return True
+        buckets, weights = analyze_headline(earlier_text)
+        if vector[buckets] @ weights >= similarity_threshold:
+            return True
+    return False